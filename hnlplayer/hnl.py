@@ -2,15 +2,20 @@
 # -*- coding: utf-8 -*-
 # vim:ts=2:sw=2:et:ai
 
-import copy
+import collections
+import functools
+import itertools
+import json
 import mutagen
 import os.path
+import sqlite3
 import sys
+import threading
 import traceback
 
 from euphonogenizer import titleformat as tf
 
-from typing import Dict, List
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
 
 from PyQt5 import QtCore
 from PyQt5.QtCore import *
@@ -30,20 +35,37 @@ class InvalidActionError(BenignError):
   pass
 
 
+_iconCache: Dict[Tuple[int, int, int], QPixmap] = {}
+
+
 def get_standard_icon(
     style: QStyle, sp: QStyle.StandardPixmap,
     minimumWidth: int, parent: QWidget = None) -> QLabel:
-  si = style.standardIcon(sp)
+  key = (id(style), int(sp), minimumWidth)
+  pixmap = _iconCache.get(key)
+  if pixmap is None:
+    si = style.standardIcon(sp)
+    i = 0
+    avail = si.availableSizes()
+    l = len(avail)
+    while i < l and avail[i].width() < minimumWidth:
+      i += 1
+    pixmap = _iconCache[key] = si.pixmap(avail[i])
   icon = QLabel(parent)
-  i = 0
-  avail = si.availableSizes()
-  l = len(avail)
-  while i < l and avail[i].width() < minimumWidth:
-    i += 1
-  icon.setPixmap(si.pixmap(avail[i]))
+  icon.setPixmap(pixmap)
   return icon
 
 
+@functools.lru_cache(maxsize=None)
+def standard_icon(sp: QStyle.StandardPixmap) -> QIcon:
+  return QApplication.style().standardIcon(sp)
+
+
+def clear_icon_caches() -> None:
+  _iconCache.clear()
+  standard_icon.cache_clear()
+
+
 class InternalErrorDialog(QDialog):
   def __init__(self, title, msg, parent=None):
     super().__init__(parent)
@@ -60,7 +82,8 @@ class InternalErrorDialog(QDialog):
     self.icon = get_standard_icon(
         self.style(), QStyle.SP_MessageBoxCritical, 32, self)
 
-    self.msg = QLabel(f'An unexpected error occurred.\n\n{msg}', self)
+    self.msg = QLabel(self)
+    self.setMessage(msg)
 
     self.msg.setWordWrap(True)
     self.msg.setAlignment(Qt.AlignLeft | Qt.AlignTop)
@@ -80,6 +103,9 @@ class InternalErrorDialog(QDialog):
     self.okButton.clicked.connect(self.accept)
     self.showDetailsButton.clicked.connect(lambda: self.done(2))
 
+  def setMessage(self, msg):
+    self.msg.setText(f'An unexpected error occurred.\n\n{msg}')
+
 
 class ShowErrorDetailsDialog(QDialog):
   def __init__(self, title, msg, parent=None):
@@ -102,13 +128,37 @@ class ShowErrorDetailsDialog(QDialog):
     self.gridLayout.addWidget(self.detailsBox)
     self.gridLayout.addWidget(self.okButton, 0, Qt.AlignCenter)
 
+  def setDetails(self, msg):
+    self.detailsBox.setPlainText(msg)
+
 
 def hnl_exception_hook(etype, value, tb):
-  dialog = InternalErrorDialog('Internal Error', str(value))
+  # Later errors replace the one shown while the dialog is open
+  hnl_exception_hook.lastError = (etype, value, tb)
+  dialog = hnl_exception_hook.errorDialog
+  if dialog is None:
+    dialog = InternalErrorDialog('Internal Error', str(value))
+    hnl_exception_hook.errorDialog = dialog
+  else:
+    dialog.setMessage(str(value))
+    if dialog.isVisible():
+      return
+
   if dialog.exec() == 2:
-    dialog = ShowErrorDetailsDialog('Error Details',
-        ''.join(traceback.format_exception(etype, value, tb)))
-    dialog.exec()
+    details = ''.join(
+        traceback.format_exception(*hnl_exception_hook.lastError))
+    detailsDialog = hnl_exception_hook.detailsDialog
+    if detailsDialog is None:
+      detailsDialog = ShowErrorDetailsDialog('Error Details', details)
+      hnl_exception_hook.detailsDialog = detailsDialog
+    else:
+      detailsDialog.setDetails(details)
+    detailsDialog.exec()
+
+
+hnl_exception_hook.lastError = None
+hnl_exception_hook.errorDialog = None
+hnl_exception_hook.detailsDialog = None
 
 
 sys.excepthook = hnl_exception_hook
@@ -127,41 +177,326 @@ mutagen_redirect_keys: Dict[str, str] = {
 }
 
 
+_marshal = mutagen_redirect_keys.get
+
+
 def marshal_key(key: str) -> str:
-  if key not in mutagen_redirect_keys:
-    return key
-  return mutagen_redirect_keys[key]
+  return _marshal(key, key)
 
 
 class MutagenFileProxy:
-  __slots__ = 'mutagen_file'
+  __slots__ = 'mutagen_file', 'path', 'formatCache'
 
-  def __init__(self, mutagen_file):
+  def __init__(self, mutagen_file, path: str):
     self.mutagen_file = mutagen_file
+    self.path = path
+    self.formatCache: Dict[str, str] = {}
+
+  @property
+  def tags(self):
+    return self.mutagen_file.tags
+
+  @property
+  def info(self):
+    return self.mutagen_file.info
+
+  def keys(self):
+    return self.mutagen_file.keys()
+
+  def values(self):
+    return self.mutagen_file.values()
+
+  def items(self):
+    return self.mutagen_file.items()
+
+  def pprint(self):
+    return self.mutagen_file.pprint()
 
-  def __getattr__(self, attr):
-    if attr in (
-        'get', 'mutagen_file', '__getitem__', '__setitem__', '__delitem__'):
-      return object.__getattribute__(self, attr)
-    return getattr(self.mutagen_file, attr)
+  def __contains__(self, key):
+    return _marshal(key, key) in self.mutagen_file
 
   def get(self, key, default=None):
-    item = self.mutagen_file.get(marshal_key(key), default)
-    if isinstance(item, list):
-      return item[0]
-    return item
+    item = self.mutagen_file.get(_marshal(key, key), default)
+    return item[0] if item.__class__ is list else item
 
   def __getitem__(self, key):
-    item = self.mutagen_file[marshal_key(key)]
-    if isinstance(item, list):
-      return item[0]
-    return item
+    item = self.mutagen_file[_marshal(key, key)]
+    return item[0] if item.__class__ is list else item
 
   def __setitem__(self, key, value):
     self.mutagen_file[key] = value
+    self.formatCache.clear()
 
   def __delitem__(self, key):
     del self.mutagen_file[key]
+    self.formatCache.clear()
+
+
+# Only the file name is shown until the track is scrolled into view
+class TrackStub(MutagenFileProxy):
+  __slots__ = 'loading',
+
+  def __init__(self, path: str, tags: Optional[dict] = None):
+    if tags is None:
+      tags = {'title': [os.path.basename(path)]}
+    else:
+      # Matched case-insensitively like mutagen's easy tags
+      tags = {key.lower(): value for key, value in tags.items()}
+    super().__init__(tags, path)
+    self.loading = False
+
+  @property
+  def tags(self):
+    return self.mutagen_file
+
+  @property
+  def info(self):
+    return None
+
+  def pprint(self):
+    return '\n'.join(
+        f'{key}={value}'
+        for key, values in sorted(self.mutagen_file.items())
+        for value in values)
+
+  def __contains__(self, key):
+    return super().__contains__(key.lower())
+
+  def get(self, key, default=None):
+    return super().get(key.lower(), default)
+
+  def __getitem__(self, key):
+    return super().__getitem__(key.lower())
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key.lower(), value)
+
+  def __delitem__(self, key):
+    super().__delitem__(key.lower())
+
+
+# Tags from the tag cache. The file is read when info is first asked for.
+class CachedTrack(TrackStub):
+  __slots__ = '_file',
+
+  def __init__(self, path: str, tags: dict):
+    super().__init__(path, tags)
+    self._file = None
+
+  def _loadFile(self):
+    if self._file is None:
+      try:
+        mutagen_file = mutagen.File(self.path, easy=True)
+      except mutagen.MutagenError:
+        mutagen_file = None
+      # False marks a file that couldn't be read so it isn't tried again
+      self._file = False if mutagen_file is None else mutagen_file
+    return self._file
+
+  @property
+  def info(self):
+    mutagen_file = self._loadFile()
+    return mutagen_file.info if mutagen_file is not False else None
+
+  def pprint(self):
+    mutagen_file = self._loadFile()
+    if mutagen_file is False:
+      return super().pprint()
+    return mutagen_file.pprint()
+
+
+audio_file_extensions = frozenset((
+    '.aac', '.aif', '.aiff', '.alac', '.ape', '.asf', '.dff', '.dsf', '.flac',
+    '.m4a', '.m4b', '.mp2', '.mp3', '.mp4', '.mpc', '.oga', '.ogg', '.opus',
+    '.spx', '.tta', '.wav', '.wma', '.wv'))
+
+
+def is_audio_file(path: str) -> bool:
+  return os.path.splitext(path)[1].lower() in audio_file_extensions
+
+
+def iter_track_paths(root: str) -> Iterator[str]:
+  if os.path.isfile(root):
+    if is_audio_file(root):
+      yield root
+    return
+
+  stack = [root] if os.path.isdir(root) else []
+  while stack:
+    subdirs = []
+    try:
+      with os.scandir(stack.pop()) as it:
+        for entry in it:
+          if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+          elif entry.is_file() and is_audio_file(entry.name):
+            yield entry.path
+    except OSError:
+      continue
+    stack.extend(reversed(subdirs))
+
+
+# Entries are invalidated by a change in the file's mtime or size
+class TagCache:
+  def __init__(self, path: str):
+    self.path = path
+    self._local = threading.local()
+
+  def _connection(self) -> sqlite3.Connection:
+    conn = getattr(self._local, 'connection', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=10)
+      try:
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA journal_mode=MEMORY')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS tags('
+            'path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, blob BLOB)')
+      except sqlite3.Error:
+        conn.close()
+        raise
+      self._local.connection = conn
+    return conn
+
+  def get(self, track_path: str) -> Optional[dict]:
+    try:
+      st = os.stat(track_path)
+      row = self._connection().execute(
+          'SELECT mtime, size, blob FROM tags WHERE path = ?',
+          (track_path,)).fetchone()
+      if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+        return json.loads(row[2])
+    except (OSError, ValueError, sqlite3.Error):
+      pass
+    return None
+
+  def put(self, track_path: str, tags: dict) -> None:
+    try:
+      st = os.stat(track_path)
+      blob = json.dumps(tags)
+      conn = self._connection()
+      with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)',
+            (track_path, st.st_mtime_ns, st.st_size, blob))
+    except (OSError, TypeError, ValueError, sqlite3.Error):
+      pass
+
+
+tag_cache: Optional[TagCache] = None
+
+
+def open_tag_cache() -> None:
+  global tag_cache
+  cacheDir = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
+  try:
+    if not cacheDir:
+      raise OSError('No cache location available')
+    os.makedirs(cacheDir, exist_ok=True)
+  except OSError as e:
+    print(f'Tag cache disabled: {e}')
+    tag_cache = None
+    return
+  tag_cache = TagCache(os.path.join(cacheDir, 'tags.db'))
+
+
+def load_track(track_path: str) -> Optional[MutagenFileProxy]:
+  try:
+    track = mutagen.File(track_path, easy=True)
+  except mutagen.MutagenError:
+    track = None
+  # An untagged file is empty but still loaded
+  if track is not None:
+    if tag_cache is not None:
+      tag_cache.put(track_path, dict(track.items()))
+    return MutagenFileProxy(track, track_path)
+  print(f'Failed to load file "{track_path}"')
+
+
+def load_track_stub(track_path: str) -> TrackStub:
+  if tag_cache is not None:
+    tags = tag_cache.get(track_path)
+    if tags is not None:
+      return CachedTrack(track_path, tags)
+  return TrackStub(track_path)
+
+
+trackLoadChunkSize = 64
+
+trackInsertChunkSize = 512
+
+
+# Finished chunks wait in `ready` until every chunk before them is inserted
+class TrackLoadRequest:
+  __slots__ = 'row', 'chunkCount', 'nextChunk', 'ready'
+
+  def __init__(self, row: int, chunkCount: int):
+    self.row = row
+    self.chunkCount = chunkCount
+    self.nextChunk = 0
+    self.ready: Dict[int, List[MutagenFileProxy]] = {}
+
+
+class PendingInsert:
+  __slots__ = 'row', 'tracks'
+
+  def __init__(self, row: int, tracks: List[MutagenFileProxy]):
+    self.row = row
+    self.tracks = tracks
+
+
+class TrackLoadSignals(QObject):
+  loaded = pyqtSignal(object, int, list)
+
+
+class TrackLoadRunnable(QRunnable):
+  def __init__(self, request: TrackLoadRequest, chunk: int, paths: List[str]):
+    super().__init__()
+    self.request = request
+    self.chunk = chunk
+    self.paths = paths
+    self.signals = TrackLoadSignals()
+
+  def run(self):
+    # Always emitted so later chunks of the load aren't left waiting
+    tracks = []
+    try:
+      for track_path in self.paths:
+        try:
+          track = load_track_stub(track_path)
+        except Exception:
+          print(f'Failed to load file "{track_path}"')
+          traceback.print_exc()
+          continue
+        if track:
+          tracks.append(track)
+    finally:
+      self.signals.loaded.emit(self.request, self.chunk, tracks)
+
+
+class TrackParseSignals(QObject):
+  parsed = pyqtSignal(list)
+
+
+class TrackParseRunnable(QRunnable):
+  def __init__(self, stubs: List[Tuple[int, TrackStub]]):
+    super().__init__()
+    self.stubs = stubs
+    self.signals = TrackParseSignals()
+
+  def run(self):
+    results = []
+    try:
+      for row, stub in self.stubs:
+        try:
+          track = load_track(stub.path)
+        except Exception:
+          print(f'Failed to load file "{stub.path}"')
+          traceback.print_exc()
+          track = None
+        results.append((row, stub, track))
+    finally:
+      self.signals.parsed.emit(results)
 
 
 playlistAllowedMimeTypes = [
@@ -170,34 +505,50 @@ playlistAllowedMimeTypes = [
 ]
 
 
+@functools.lru_cache(maxsize=256)
+def compile_fmt(fmt: str):
+  return tf.compile(fmt)
+
+
 class PlaylistColumn:
-  __slots__ = 'name', 'defaultWidth', '_fmt', '_tfc'
+  __slots__ = 'name', 'defaultWidth', 'fmt', '_tfc'
 
   def __init__(self, name='', defaultWidth=180, fmt=''):
     self.name = name
     self.defaultWidth = defaultWidth
-    self.fmt = fmt
+    self.setFmt(fmt)
 
-  @property
-  def fmt(self):
-    return self._fmt
-
-  @fmt.setter
-  def fmt(self, fmt: str):
-    self._fmt = fmt
-    self._tfc = tf.compile(fmt)
+  def setFmt(self, fmt: str) -> None:
+    self.fmt = fmt
+    self._tfc = compile_fmt(fmt)
 
   def format(self, track):
     return self._tfc(track)
 
+  def clone(self):
+    column = PlaylistColumn.__new__(PlaylistColumn)
+    column.name = self.name
+    column.defaultWidth = self.defaultWidth
+    column.fmt = self.fmt
+    column._tfc = self._tfc
+    return column
+
   def __copy__(self):
-    return PlaylistColumn(self.name, self.defaultWidth, self.fmt)
+    return self.clone()
 
   def __deepcopy__(self, memo=None):
-    return PlaylistColumn(self.name, self.defaultWidth, self.fmt)
+    return self.clone()
+
+
+MultipleRolesRole = Qt.UserRole + 1
 
 
 class PlaylistModel(QAbstractTableModel):
+  _validFlags = (
+      Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren
+      | Qt.ItemIsDragEnabled)
+  _invalidFlags = Qt.ItemFlags(Qt.ItemIsDropEnabled)
+
   def __init__(
       self,
       columns: List[PlaylistColumn],
@@ -206,6 +557,20 @@ class PlaylistModel(QAbstractTableModel):
     super().__init__(parent)
     self._columns: List[PlaylistColumn] = columns
     self._tracks: List[MutagenFileProxy] = tracks
+    self._cacheColumns()
+
+    self._pendingLoads: Dict[TrackLoadRequest, None] = {}
+    self._loadRequests: Dict[TrackLoadRequest, None] = {}
+    self._loadFlushTimer = QTimer(self)
+    self._loadFlushTimer.setSingleShot(True)
+    self._loadFlushTimer.setInterval(50)
+    self._loadFlushTimer.timeout.connect(self.flushLoadedTracks)
+
+    self._pendingInserts: Deque[PendingInsert] = collections.deque()
+
+    self.rowsInserted.connect(self._onRowsInserted)
+    self.rowsRemoved.connect(self._onRowsRemoved)
+    self.rowsMoved.connect(self._onRowsMoved)
 
   @property
   def columns(self):
@@ -213,9 +578,44 @@ class PlaylistModel(QAbstractTableModel):
 
   @columns.setter
   def columns(self, columns: List[PlaylistColumn]) -> None:
-    self.layoutAboutToBeChanged.emit()
+    if len(columns) != len(self._columns):
+      self.beginResetModel()
+      self._columns = columns
+      self._cacheColumns()
+      self.endResetModel()
+      return
+
     self._columns = columns
-    self.layoutChanged.emit()
+    self._cacheColumns()
+    if columns:
+      self.headerDataChanged.emit(Qt.Horizontal, 0, len(columns) - 1)
+      if self._tracks:
+        self.dataChanged.emit(
+            self.index(0, 0),
+            self.index(len(self._tracks) - 1, len(columns) - 1))
+
+  def _cacheColumns(self) -> None:
+    self._headerNames: List[str] = [col.name for col in self._columns]
+    self._formats: List[str] = [col.fmt for col in self._columns]
+    self._formatters = [col.format for col in self._columns]
+
+    # One list of cell text per column, parallel to _tracks
+    self._display: List[List[str]] = [
+        self._formatTracks(col, self._tracks)
+        for col in range(len(self._columns))]
+
+  def _formatTracks(
+      self, col: int, tracks: List[MutagenFileProxy]) -> List[str]:
+    fmt = self._formats[col]
+    formatter = self._formatters[col]
+    texts = []
+    for track in tracks:
+      cache = track.formatCache
+      text = cache.get(fmt)
+      if text is None:
+        text = cache[fmt] = formatter(track)
+      texts.append(text)
+    return texts
 
   def getTrack(self, index: QModelIndex) -> MutagenFileProxy:
     if index.isValid():
@@ -227,110 +627,243 @@ class PlaylistModel(QAbstractTableModel):
   def columnCount(self, parent=QModelIndex()):
     return len(self.columns)
 
+  def _formatRow(self, row: int) -> None:
+    track = [self._tracks[row]]
+    for col, display in enumerate(self._display):
+      display[row] = self._formatTracks(col, track)[0]
+
   def data(self, index, role):
-    if index.isValid() and role == Qt.DisplayRole:
-      return self.columns[index.column()].format(self._tracks[index.row()])
+    if role == Qt.DisplayRole:
+      if index.isValid():
+        return self._display[index.column()][index.row()]
+    elif role == MultipleRolesRole:
+      if index.isValid():
+        return {Qt.DisplayRole: self._display[index.column()][index.row()]}
 
   def headerData(self, section, orientation, role):
     if role == Qt.DisplayRole and orientation == Qt.Horizontal:
-      return self.columns[section].name
+      return self._headerNames[section]
+
+  def invalidateTrack(self, row: int) -> None:
+    self._tracks[row].formatCache.clear()
+    self._formatRow(row)
+    self.dataChanged.emit(
+        self.index(row, 0), self.index(row, len(self._columns) - 1))
 
   def insertTrack(self, row, track):
-    if row < 0:
+    self.insertTracks(row, [track])
+
+  def insertTracks(self, row, tracks: List[MutagenFileProxy]) -> None:
+    if not tracks:
+      return
+    if not self._pendingInserts and len(tracks) <= trackInsertChunkSize:
+      self._insertTracksNow(row, tracks)
+      return
+
+    # Chunks share the batch's row and are pushed down as earlier ones go in
+    idle = not self._pendingInserts
+    for i in range(0, len(tracks), trackInsertChunkSize):
+      self._pendingInserts.append(
+          PendingInsert(row, tracks[i:i + trackInsertChunkSize]))
+    if idle:
+      QTimer.singleShot(0, self._insertNextChunk)
+
+  def _insertNextChunk(self) -> None:
+    pending = self._pendingInserts.popleft()
+    self._insertTracksNow(pending.row, pending.tracks)
+    if self._pendingInserts:
+      QTimer.singleShot(0, self._insertNextChunk)
+
+  def _insertTracksNow(self, row, tracks: List[MutagenFileProxy]) -> None:
+    if row < 0 or row > len(self._tracks):
       row = len(self._tracks)
-    self.layoutAboutToBeChanged.emit()
-    self._tracks.insert(row, track)
-    self.layoutChanged.emit()
+    self.beginInsertRows(QModelIndex(), row, row + len(tracks) - 1)
+    self._tracks[row:row] = tracks
+    for col, display in enumerate(self._display):
+      display[row:row] = self._formatTracks(col, tracks)
+    self.endInsertRows()
 
   def insertTrackPath(self, row, track_path):
-    track = mutagen.File(track_path, easy=True)
-    if track:
-      self.insertTrack(row, MutagenFileProxy(track))
-    else:
-      print(f'Failed to insert file "{track_path}"')
+    if not is_audio_file(track_path):
+      return
+    track = load_track(track_path)
+    if track is not None:
+      self.insertTrack(row, track)
+
+  def loadTrackPaths(self, row, paths: List[str]) -> None:
+    starts = range(0, len(paths), trackLoadChunkSize)
+    if not starts:
+      return
+    request = TrackLoadRequest(row, len(starts))
+    self._loadRequests[request] = None
+    pool = QThreadPool.globalInstance()
+    for chunk, i in enumerate(starts):
+      runnable = TrackLoadRunnable(
+          request, chunk, paths[i:i + trackLoadChunkSize])
+      runnable.signals.loaded.connect(self.onTracksLoaded)
+      pool.start(runnable)
+
+  def onTracksLoaded(self, request, chunk, tracks):
+    request.ready[chunk] = tracks
+    self._pendingLoads[request] = None
+    if not self._loadFlushTimer.isActive():
+      self._loadFlushTimer.start()
+
+  def flushLoadedTracks(self):
+    pending, self._pendingLoads = self._pendingLoads, {}
+    for request in pending:
+      tracks = []
+      while request.nextChunk in request.ready:
+        tracks.extend(request.ready.pop(request.nextChunk))
+        request.nextChunk += 1
+      if request.nextChunk == request.chunkCount:
+        del self._loadRequests[request]
+      self.insertTracks(request.row, tracks)
+
+  # Rows waiting to be inserted follow the playlist. Negative rows append.
+  def _rowAnchors(self):
+    return [
+        anchor
+        for anchor in itertools.chain(self._loadRequests, self._pendingInserts)
+        if anchor.row >= 0]
+
+  def _onRowsInserted(self, parent, first, last):
+    for anchor in self._rowAnchors():
+      if anchor.row >= first:
+        anchor.row += last - first + 1
+
+  def _onRowsRemoved(self, parent, first, last):
+    for anchor in self._rowAnchors():
+      if anchor.row > last:
+        anchor.row -= last - first + 1
+      elif anchor.row > first:
+        anchor.row = first
+
+  def _onRowsMoved(self, parent, start, end, destination, destinationRow):
+    count = end - start + 1
+    if destinationRow > end:
+      destinationRow -= count
+    for anchor in self._rowAnchors():
+      if anchor.row > end:
+        anchor.row -= count
+      elif anchor.row > start:
+        anchor.row = start
+      if anchor.row >= destinationRow:
+        anchor.row += count
+
+  def loadStubs(self, first: int, last: int) -> None:
+    stubs = []
+    for row in range(first, last + 1):
+      track = self._tracks[row]
+      # Cached tracks and stubs already being parsed are skipped
+      if track.__class__ is TrackStub and not track.loading:
+        track.loading = True
+        stubs.append((row, track))
+
+    pool = QThreadPool.globalInstance()
+    for i in range(0, len(stubs), trackLoadChunkSize):
+      runnable = TrackParseRunnable(stubs[i:i + trackLoadChunkSize])
+      runnable.signals.parsed.connect(self.onStubsParsed)
+      pool.start(runnable)
+
+  def onStubsParsed(self, results):
+    top, bottom = len(self._tracks), -1
+    failed = []
+    for row, stub, track in results:
+      if row >= len(self._tracks) or self._tracks[row] is not stub:
+        # Rows were inserted, moved or removed while the stub was parsing
+        try:
+          row = self._tracks.index(stub)
+        except ValueError:
+          continue
+      # Files mutagen can't read are dropped
+      if track is None:
+        failed.append(row)
+        continue
+      self._tracks[row] = track
+      self._formatRow(row)
+      top = min(top, row)
+      bottom = max(bottom, row)
+
+    if top <= bottom:
+      self.dataChanged.emit(
+          self.index(top, 0), self.index(bottom, len(self._columns) - 1))
+    if failed:
+      self.removeRowsBatch(failed)
 
   def moveRow(
       self, sourceParent, sourceRow, destinationParent, destinationChild):
-    self.beginMoveRows(
-        sourceParent, sourceRow, sourceRow,
-        destinationParent, destinationChild)
-    if sourceRow > destinationChild:
-      self._tracks.insert(destinationChild, self._tracks.pop(sourceRow))
-    elif sourceRow < destinationChild:
-      self._tracks.insert(destinationChild - 1, self._tracks.pop(sourceRow))
-    self.endMoveRows()
-    return True
+    return self.moveRows(
+        sourceParent, sourceRow, 1, destinationParent, destinationChild)
 
   def moveRows(
       self, sourceParent, sourceRow, count,
       destinationParent, destinationChild):
-    self.beginMoveRows(
+    if not self.beginMoveRows(
         sourceParent, sourceRow, sourceRow + count - 1,
-        destinationParent, destinationChild)
-    if sourceRow > destinationChild:
-      self._tracks = (self._tracks[:destinationChild]
-              + self._tracks[destinationChild:sourceRow]
-              + self._tracks[sourceRow:sourceRow+count]
-              + self._tracks[sourceRow+count:])
-    else:
-      self._tracks = (self._tracks[:sourceRow]
-              + self._tracks[sourceRow:sourceRow+count]
-              + self._tracks[sourceRow+count:destinationChild]
-              + self._tracks[destinationChild:])
+        destinationParent, destinationChild):
+      return False
+    move_block(self._tracks, sourceRow, count, destinationChild)
+    for display in self._display:
+      move_block(display, sourceRow, count, destinationChild)
     self.endMoveRows()
     return True
 
   def removeRow(self, row, parent):
-    self.beginRemoveRows(parent, row, row)
-    del self._tracks[row]
-    self.endRemoveRows()
-    return True
+    return self.removeRows(row, 1, parent)
 
   def removeRows(self, row, count, parent):
+    if count <= 0:
+      return False
     self.beginRemoveRows(parent, row, row + count - 1)
-    del self._tracks[row:row + count - 1]
+    del self._tracks[row:row + count]
+    for display in self._display:
+      del display[row:row + count]
     self.endRemoveRows()
     return True
 
+  def removeRowsBatch(self, rows: List[int], parent=QModelIndex()) -> None:
+    # Last run first so the earlier row numbers stay valid
+    runs = [
+        [row for _, row in run] for _, run in itertools.groupby(
+            enumerate(sorted(set(rows))), key=lambda p: p[1] - p[0])]
+    for run in reversed(runs):
+      self.removeRows(run[0], len(run), parent)
+
   def supportedDropActions(self):
     return Qt.CopyAction | Qt.MoveAction
 
   def flags(self, index: QModelIndex) -> Qt.ItemFlags:
-    if index.isValid():
-      return Qt.ItemIsDragEnabled | super().flags(index)
-    return Qt.ItemIsDropEnabled | super().flags(index)
+    return self._validFlags if index.isValid() else self._invalidFlags
 
   def mimeTypes(self):
     return playlistAllowedMimeTypes
 
   def dropMimeData(self, data, action, row, column, parent):
     if action & Qt.CopyAction and data.hasUrls():
-      row_delta = row >= 0
-      for each in data.urls():
-        each = each.toString(QUrl.PreferLocalFile)
-        print(each)
-        if os.path.isfile(each):
-          self.insertTrackPath(row, each)
-          row += row_delta
-        elif os.path.isdir(each):
-          for dirpath, dirnames, filenames in os.walk(each):
-            for filename in filenames:
-              fullpath = os.path.join(dirpath, filename)
-              if os.path.isfile(fullpath):
-                self.insertTrackPath(row, fullpath)
-                row += row_delta
+      paths = []
+      for url in data.urls():
+        if url.isLocalFile():
+          paths.extend(iter_track_paths(url.toLocalFile()))
 
+      self.loadTrackPaths(row, paths)
       return True
     return super().dropMimeData(data, action, row, column, parent)
 
 
-def is_contiguous(seq):
-  last = seq[0].row()
+def move_block(items: list, start: int, count: int, dest: int) -> None:
+  # Rotates only the span between the block and its destination
+  if dest > start + count:
+    window = items[start:dest]
+    items[start:dest] = window[count:] + window[:count]
+  elif dest < start:
+    window = items[dest:start + count]
+    items[dest:start + count] = window[-count:] + window[:-count]
 
-  for i in seq:
-    if i.row() != last + 1 and i.row() != last:
-      return False
-  return True
+
+def is_contiguous(seq):
+  # seq must be sorted by row with no duplicates
+  return seq[-1].row() - seq[0].row() == len(seq) - 1
 
 
 def set_basic_table_styles(
@@ -401,7 +934,7 @@ class ColumnConfigurationLayout(QGridLayout):
       parent: QWidget):
     super().__init__(parent)
 
-    columns = copy.deepcopy(columns)
+    columns = [col.clone() for col in columns]
     self.columns = columns
     self.mainWindow = mainWindow
     self.parent = parent
@@ -439,6 +972,14 @@ class ColumnConfigurationLayout(QGridLayout):
     self.columnWidthTextBox.textEdited.connect(self.onColumnWidthEdited)
     self.columnFormatTextBox.textEdited.connect(self.onColumnFormatEdited)
 
+    self._pendingFmt = None
+    self._fmtDebounce = QTimer(parent)
+    self._fmtDebounce.setSingleShot(True)
+    self._fmtDebounce.setInterval(150)
+    self._fmtDebounce.timeout.connect(self.commitPendingFormat)
+
+    self._dirtyCells = None
+
     self.previewLabel = QLabel('Preview:', parent)
     self.previewTextBox = QLineEdit(parent)
     self.previewLabel.setBuddy(self.previewTextBox)
@@ -475,10 +1016,12 @@ class ColumnConfigurationLayout(QGridLayout):
     self.selectionModel.currentRowChanged.connect(self.onCurrentRowChanged)
 
   def onCurrentRowChanged(self, current, previous):
+    self.commitPendingFormat()
     col = self.columns[current.row()]
     self.columnNameTextBox.setText(col.name)
     self.columnWidthTextBox.setText(str(col.defaultWidth))
     self.columnFormatTextBox.setText(col.fmt)
+    self.updatePreview(col)
 
   def onColumnNameChanged(self, text):
     pass
@@ -495,27 +1038,67 @@ class ColumnConfigurationLayout(QGridLayout):
     self.handleColumnEdit(1, text)
 
   def onColumnFormatChanged(self, text):
-    self.previewTextBox.setText(
-        str(tf.format(text, self.mainWindow.playlistView.currentTrack)))
+    pass
 
   def onColumnFormatEdited(self, text):
     self.onColumnFormatChanged(text)
-    self.handleColumnEdit(2, text)
+    index = self.selectionModel.currentIndex()
+    if index.isValid():
+      self._pendingFmt = (index.row(), text)
+      self._fmtDebounce.start()
+
+  def commitPendingFormat(self):
+    self._fmtDebounce.stop()
+    if self._pendingFmt is None:
+      return
+    row, text = self._pendingFmt
+    self._pendingFmt = None
+    self.applyColumnEdit(row, 2, text)
+    self.updatePreview(self.columns[row])
+
+  def discardPendingFormat(self):
+    self._fmtDebounce.stop()
+    self._pendingFmt = None
+
+  def updatePreview(self, col: PlaylistColumn) -> None:
+    self.previewTextBox.setText(
+        str(col.format(self.mainWindow.playlistView.currentTrack)))
 
   def handleColumnEdit(self, col, text):
     index = self.selectionModel.currentIndex()
     if index.isValid():
-      row = index.row()
-      if col == 0:
-        self.columns[row].name = text
-      elif col == 1:
-        self.columns[row].defaultWidth = int(text) if text else 0
-      elif col == 2:
-        self.columns[row].fmt = text
-      else:
-        raise IndexError(f"Can't edit nonexistent column {col}.")
-      index = self.columnsTableView.columnsModel.createIndex(row, col)
-      self.columnsTableView.dataChanged(index, index)
+      self.applyColumnEdit(index.row(), col, text)
+
+  def applyColumnEdit(self, row, col, text):
+    if col == 0:
+      self.columns[row].name = text
+    elif col == 1:
+      self.columns[row].defaultWidth = int(text) if text else 0
+    elif col == 2:
+      self.columns[row].setFmt(text)
+    else:
+      raise IndexError(f"Can't edit nonexistent column {col}.")
+    self.markCellDirty(row, col)
+
+  def markCellDirty(self, row, col):
+    if self._dirtyCells is None:
+      self._dirtyCells = (row, row, col, col)
+      QTimer.singleShot(0, self.emitDirtyCells)
+    else:
+      top, bottom, left, right = self._dirtyCells
+      self._dirtyCells = (
+          min(top, row), max(bottom, row), min(left, col), max(right, col))
+
+  def emitDirtyCells(self):
+    if self._dirtyCells is None:
+      return
+    top, bottom, left, right = self._dirtyCells
+    self._dirtyCells = None
+    cm = self.columnsTableView.columnsModel
+    bottom = min(bottom, cm.rowCount() - 1)
+    if top <= bottom:
+      cm.dataChanged.emit(
+          cm.index(top, left), cm.index(bottom, right), [Qt.DisplayRole])
 
   def onAddNewButtonClicked(self, checked):
     if len(self.columns) == 1:
@@ -546,6 +1129,9 @@ class ColumnConfigurationLayout(QGridLayout):
       row = index.row()
       cm = self.columnsTableView.columnsModel
 
+      # Any pending format edit belongs to the row being deleted
+      self.discardPendingFormat()
+
       cm.layoutAboutToBeChanged.emit()
       del self.columns[row]
       cm.layoutChanged.emit()
@@ -571,6 +1157,7 @@ class ColumnConfigurationLayout(QGridLayout):
     self.deleteButton.setEnabled(True)
 
   def onSaveButtonClicked(self, checked):
+    self.commitPendingFormat()
     self.mainWindow.playlistView.columns = self.columns
     if isinstance(self.parent, QDialog):
       self.parent.done(QDialog.Accepted)
@@ -589,6 +1176,22 @@ class ConfigureColumnsDialog(QDialog):
     self.contents = ColumnConfigurationLayout(columns, mainWindow, self)
 
 
+class SpeedUpDelegate(QStyledItemDelegate):
+  def initStyleOption(self, option, index):
+    roles = index.data(MultipleRolesRole)
+    if roles is None:
+      super().initStyleOption(option, index)
+      return
+
+    option.index = index
+    text = roles.get(Qt.DisplayRole)
+    if text is not None:
+      option.features |= QStyleOptionViewItem.HasDisplay
+      option.text = self.displayText(text, option.locale)
+    option.backgroundBrush = QBrush()
+    option.styleObject = None
+
+
 class PlaylistTableView(QTableView):
   def __init__(self, parent=None):
     super().__init__(parent)
@@ -603,6 +1206,7 @@ class PlaylistTableView(QTableView):
       ], [])
 
     self.setModel(self.playlist)
+    self.setItemDelegate(SpeedUpDelegate(self))
     self.nowPlaying: int = -1
 
     hh = self.horizontalHeader()
@@ -622,6 +1226,17 @@ class PlaylistTableView(QTableView):
     self.addColumn = ccm.addAction('Add Column...', lambda: None)
     self.columnContextMenu = ccm
 
+    self._visibleLoadTimer = QTimer(self)
+    self._visibleLoadTimer.setSingleShot(True)
+    self._visibleLoadTimer.setInterval(0)
+    self._visibleLoadTimer.timeout.connect(self.loadVisibleTracks)
+    scheduleLoad = lambda *args: self._visibleLoadTimer.start()
+    self.verticalScrollBar().valueChanged.connect(scheduleLoad)
+    self.playlist.rowsInserted.connect(scheduleLoad)
+    self.playlist.rowsMoved.connect(scheduleLoad)
+    self.playlist.rowsRemoved.connect(scheduleLoad)
+    self.playlist.modelReset.connect(scheduleLoad)
+
     vh.setSectionsMovable(True)
     vh.setDragEnabled(True)
     vh.setDragDropMode(QAbstractItemView.InternalMove)
@@ -654,6 +1269,20 @@ class PlaylistTableView(QTableView):
     track = self.playlist.getTrack(trackIndex)
     self.mainWindow.updateTitleForPlayingTrack(track)
 
+  def resizeEvent(self, event):
+    super().resizeEvent(event)
+    self._visibleLoadTimer.start()
+
+  def loadVisibleTracks(self):
+    count = self.playlist.rowCount()
+    if not count:
+      return
+    first = max(self.rowAt(0), 0)
+    last = self.rowAt(self.viewport().height() - 1)
+    if last < 0:
+      last = count - 1
+    self.playlist.loadStubs(first, last)
+
   def enactColumnContextMenu(self, pos):
     self.columnContextMenu.exec_(self.mapToGlobal(pos))
 
@@ -666,7 +1295,7 @@ class PlaylistTableView(QTableView):
         if not selectionModel.hasSelection():
           return
 
-        moving = list(sorted(item for item in selectionModel.selectedRows()))
+        moving = sorted(selectionModel.selectedRows(), key=QModelIndex.row)
 
         if moving:
           pos = event.pos()
@@ -717,32 +1346,50 @@ class NowPlayingSlider(QSlider):
     self.setStyle(SliderSelectDirectJumpProxyStyle(self.style()))
 
 
-class PlayerFileMenuContainer:
+class LazyMenuContainer:
+  # (text, attribute, handler method name or None); no text is a separator
+  menuItems: List[Tuple[Optional[str], str, Optional[str]]] = []
+
   def __init__(self, mainWindow, menu):
+    self.mainWindow = mainWindow
     self.menu = menu
-    self.open = menu.addAction('Open...', lambda: None)
-    self.openDisc = menu.addAction('Open Disc...', lambda: None)
-    self.openSeparator = menu.addSeparator()
-    self.newPlaylist = menu.addAction('New Playlist', lambda: None)
-    self.openPlaylist = menu.addAction('Open Playlist', lambda: None)
-    self.savePlaylist = menu.addAction('Save Playlist', lambda: None)
-    self.playlistSeparator = menu.addSeparator()
-    self.exit = menu.addAction('Exit', lambda: None)
+    menu.aboutToShow.connect(self.populate)
 
+  def populate(self):
+    self.menu.aboutToShow.disconnect(self.populate)
+    for text, name, handler in self.menuItems:
+      if text is None:
+        action = self.menu.addSeparator()
+      else:
+        action = self.menu.addAction(
+            text, getattr(self, handler) if handler else lambda: None)
+      setattr(self, name, action)
 
-class PlayerEditMenuContainer:
-  def __init__(self, mainWindow, menu):
-    self.menu = menu
-    self.undo = menu.addAction('Undo', lambda: None)
-    self.redo = menu.addAction('Redo', lambda: None)
 
+class PlayerFileMenuContainer(LazyMenuContainer):
+  menuItems = [
+      ('Open...', 'open', None),
+      ('Open Disc...', 'openDisc', None),
+      (None, 'openSeparator', None),
+      ('New Playlist', 'newPlaylist', None),
+      ('Open Playlist', 'openPlaylist', None),
+      ('Save Playlist', 'savePlaylist', None),
+      (None, 'playlistSeparator', None),
+      ('Exit', 'exit', None),
+  ]
 
-class PlayerViewMenuContainer:
-  def __init__(self, mainWindow, menu):
-    self.mainWindow = mainWindow
-    self.menu = menu
-    self.configureColumns = menu.addAction(
-        'Configure Columns...', self.onConfigureColumns)
+
+class PlayerEditMenuContainer(LazyMenuContainer):
+  menuItems = [
+      ('Undo', 'undo', None),
+      ('Redo', 'redo', None),
+  ]
+
+
+class PlayerViewMenuContainer(LazyMenuContainer):
+  menuItems = [
+      ('Configure Columns...', 'configureColumns', 'onConfigureColumns'),
+  ]
 
   def onConfigureColumns(self):
     configureColumnsDialog = ConfigureColumnsDialog(
@@ -760,12 +1407,12 @@ class PlayerLibraryMenuContainer:
     self.menu = menu
 
 
-class PlayerHelpMenuContainer:
-  def __init__(self, mainWindow, menu):
-    self.menu = menu
-    self.checkForUpdates = menu.addAction('Check for Updates...', lambda: None)
-    self.creditsSeparator = menu.addSeparator()
-    self.about = menu.addAction('About', lambda: None)
+class PlayerHelpMenuContainer(LazyMenuContainer):
+  menuItems = [
+      ('Check for Updates...', 'checkForUpdates', None),
+      (None, 'creditsSeparator', None),
+      ('About', 'about', None),
+  ]
 
 
 class PlayerMenuBarContainer:
@@ -786,6 +1433,14 @@ class PlayerMenuBarContainer:
 
 
 class PlayerMainWindow(QMainWindow):
+  playerControls = [
+      (QStyle.SP_MediaStop, 'stop'),
+      (QStyle.SP_MediaPlay, 'play'),
+      (QStyle.SP_MediaPause, 'pause'),
+      (QStyle.SP_MediaSkipBackward, 'back'),
+      (QStyle.SP_MediaSkipForward, 'forward'),
+  ]
+
   def __init__(self):
     super().__init__()
     self.setWindowTitle('HNL')
@@ -801,30 +1456,32 @@ class PlayerMainWindow(QMainWindow):
     self.centralWidget.setLayout(self.layout)
     self.setCentralWidget(self.centralWidget)
 
-    self.playingTitleFormat = tf.compile(
+    self.playingTitleFormat = compile_fmt(
       "HNL - %title% - %artist% - %album% '('#%track% / %totaltracks%')'")
+    self._lastTitle = None
 
   def buildPlayerControlsToolbar(self):
-    style = self.style()
     toolbar = self.addToolBar('Controls')
-    stop = toolbar.addAction(
-        style.standardIcon(QStyle.SP_MediaStop), '', lambda: None)
-    play = toolbar.addAction(
-        style.standardIcon(QStyle.SP_MediaPlay), '', lambda: None)
-    pause = toolbar.addAction(
-        style.standardIcon(QStyle.SP_MediaPause), '', lambda: None)
-    back = toolbar.addAction(
-        style.standardIcon(QStyle.SP_MediaSkipBackward), '', lambda: None)
-    forward = toolbar.addAction(
-        style.standardIcon(QStyle.SP_MediaSkipForward), '', lambda: None)
+    self.controlActions: Dict[str, QAction] = {}
+    for sp, name in self.playerControls:
+      self.controlActions[name] = toolbar.addAction(
+          standard_icon(sp), '', lambda: None)
     return toolbar
 
   def updateTitleForPlayingTrack(self, track: MutagenFileProxy) -> None:
-    self.setWindowTitle(self.playingTitleFormat(track))
+    title = self.playingTitleFormat(track)
+    if title == self._lastTitle:
+      return
+    self._lastTitle = title
+    self.setWindowTitle(title)
 
 
 def main():
   app = QApplication(sys.argv)
+  app.setApplicationName('hnl')
+  open_tag_cache()
+  app.paletteChanged.connect(lambda palette: clear_icon_caches())
+  QThreadPool.globalInstance().setMaxThreadCount(os.cpu_count() or 1)
   main_window = PlayerMainWindow()
   main_window.show()
   sys.exit(app.exec_())